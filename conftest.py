@@ -0,0 +1,9 @@
+import pytest
+from prefect.testing.utilities import prefect_test_harness
+
+
+@pytest.fixture(scope="session")
+def prefect_harness():
+    """Temporary Prefect API for flow-level tests (one per test session)."""
+    with prefect_test_harness():
+        yield
@@ -6,12 +6,145 @@ Common tasks and helpers used across daily, backfill, and fundamentals flows.
 
 from prefect import task, get_run_logger
 from prefect.blocks.system import Secret
+from prefect.cache_policies import NO_CACHE
 from prefect_aws import AwsCredentials
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import functools
+import gzip
+import io
 import json
+import orjson
+import random
+import requests
+import threading
+import time
 
 S3_BUCKET_NAME = "mh-guess-data"
 TICKERS_S3_KEY = "adhoc/tickers.txt"
 
+# Sized for the backfill's concurrent PUTs so threads reuse pooled connections
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+)
+
+# Threads for batched HEADs in existing_s3_keys; half the S3 pool, so uploads
+# running alongside still get connections
+S3_HEAD_WORKERS = 32
+
+# (connect, read) timeouts for Tiingo calls, in seconds
+TIINGO_TIMEOUT = (5, 30)
+
+# Max Tiingo requests in flight per process, across all task threads. A local
+# semaphore avoids a Prefect concurrency-slot round trip per task.
+TIINGO_MAX_INFLIGHT = 8
+_TIINGO_INFLIGHT = threading.BoundedSemaphore(TIINGO_MAX_INFLIGHT)
+
+# Request rate cap on top of the in-flight cap: one call per 2s (1,800/hour),
+# the pace vol_table_flow (RATE_LIMIT_DELAY) already runs at against the same
+# /daily endpoint. The account is on a paid plan (the fundamentals flows need
+# it), but the plan's hourly limit isn't recorded here; raise this only after
+# checking the Tiingo dashboard. Oversubscribing only buys 429s and retries.
+TIINGO_SECONDS_PER_REQUEST = 2
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket: at most `rate` acquisitions per `per_seconds`,
+    bursting up to `rate` after an idle period.
+    """
+
+    def __init__(self, rate: float, per_seconds: float = 1.0):
+        self.rate = rate
+        self.per_seconds = per_seconds
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds: float):
+        """
+        Hold every acquirer for `seconds`, then resume from an empty bucket so
+        callers do not all burst at once when the pause ends.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self._updated = self._paused_until
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    refill = (now - self._updated) * self.rate / self.per_seconds
+                    self._tokens = min(self.rate, self._tokens + refill)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) * self.per_seconds / self.rate
+            time.sleep(wait)
+
+
+_TIINGO_RATE_LIMITER = RateLimiter(1, per_seconds=TIINGO_SECONDS_PER_REQUEST)
+
+
+class _TiingoRetry(Retry):
+    """
+    Retry that keeps urllib3's retries inside the Tiingo limits.
+
+    Every retry attempt takes a rate-limiter token, like a first attempt, and
+    the thread gives up its in-flight slot while it backs off. On a 429 it
+    also pauses the shared rate limiter for the server's Retry-After (or the
+    backoff, if absent), so every other thread holds off instead of drawing
+    more 429s.
+
+    Only mounted on _TIINGO_SESSION, whose requests all go through
+    tiingo_get(), so the calling thread always holds an in-flight slot here.
+    """
+
+    def sleep(self, response=None):
+        if response is not None and response.status == 429:
+            delay = self.get_retry_after(response)
+            if delay is None:
+                delay = self.get_backoff_time()
+            _TIINGO_RATE_LIMITER.pause(delay + random.uniform(0, 1))
+        _TIINGO_INFLIGHT.release()
+        try:
+            super().sleep(response)
+            _TIINGO_RATE_LIMITER.acquire()
+        finally:
+            _TIINGO_INFLIGHT.acquire()
+
+
+# One pooled session for all Tiingo calls in the process, so concurrent tasks
+# reuse TLS connections instead of handshaking on every request. With
+# raise_on_status=False the last response is returned once retries run out,
+# leaving callers' raise_for_status() to surface the error.
+_TIINGO_SESSION = requests.Session()
+_TIINGO_SESSION.headers.update({'Content-Type': 'application/json'})
+_TIINGO_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=_TiingoRetry(
+        total=3,
+        backoff_factor=0.5,
+        backoff_max=30,
+        backoff_jitter=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    ),
+))
+
 
 def load_credentials():
     """Load Tiingo API token and AWS credentials from Prefect Cloud blocks."""
@@ -26,6 +159,60 @@ def load_credentials():
     return api_token, aws_credentials
 
 
+def tiingo_get(url: str, api_token: str, params: dict = None) -> requests.Response:
+    """GET a Tiingo endpoint over the shared pooled session, within the rate limits."""
+    _TIINGO_RATE_LIMITER.acquire()
+    with _TIINGO_INFLIGHT:
+        return _TIINGO_SESSION.get(
+            url,
+            headers={'Authorization': f'Token {api_token}'},
+            params=params,
+            timeout=TIINGO_TIMEOUT,
+        )
+
+
+def gzip_json(data) -> bytes:
+    """Serialize `data` as compact JSON (orjson) and gzip it for upload."""
+    buf = io.BytesIO()
+    # mtime=0 keeps the output byte-identical for identical data
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=3, mtime=0) as gz:
+        gz.write(orjson.dumps(data))
+    return buf.getvalue()
+
+
+# lru_cache has no lock of its own, so without this the backfill's threads could
+# each build a client on their first, concurrent call
+_S3_CLIENT_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=4)
+def _get_s3_client(aws_credentials: AwsCredentials):
+    # AwsCredentials hashes every field (keys, session token, profile, region,
+    # assume-role and client parameters), so each distinct block gets its own client
+    params = aws_credentials.aws_client_parameters.get_params_override()
+    block_config = params.pop('config', None)
+    config = S3_CLIENT_CONFIG.merge(block_config) if block_config else S3_CLIENT_CONFIG
+    return aws_credentials.get_boto3_session().client('s3', config=config, **params)
+
+
+def get_s3_client(aws_credentials: AwsCredentials):
+    """
+    Return the process-wide S3 client for these credentials.
+
+    Building a client parses botocore's service model, so it is done once per
+    credential set and shared across tasks (boto3 clients are thread-safe).
+    The client comes from the block's own boto3 session, so session tokens,
+    profiles, assumed roles and client parameters behave as with
+    aws_credentials.get_boto3_session().
+
+    Not aws_credentials.get_s3_client(): prefect_aws caches that per block too,
+    but builds it with the block's own botocore config, without the pool size
+    and adaptive retries in S3_CLIENT_CONFIG.
+    """
+    with _S3_CLIENT_LOCK:
+        return _get_s3_client(aws_credentials)
+
+
 @task(retries=2, retry_delay_seconds=5)
 def fetch_tickers_from_s3(bucket_name: str, s3_key: str, aws_credentials: AwsCredentials) -> list:
     """
@@ -42,7 +229,7 @@ def fetch_tickers_from_s3(bucket_name: str, s3_key: str, aws_credentials: AwsCre
     logger = get_run_logger()
     logger.info(f"Fetching tickers from s3://{bucket_name}/{s3_key}...")
 
-    s3_client = aws_credentials.get_boto3_session().client('s3')
+    s3_client = get_s3_client(aws_credentials)
 
     response = s3_client.get_object(Bucket=bucket_name, Key=s3_key)
     tickers_content = response['Body'].read().decode('utf-8')
@@ -53,11 +240,38 @@ def fetch_tickers_from_s3(bucket_name: str, s3_key: str, aws_credentials: AwsCre
     return tickers
 
 
-@task(retries=2, retry_delay_seconds=5)
+def _exists_in_s3(s3_client, bucket_name: str, s3_key: str) -> bool:
+    """Return True if the object exists (HEAD 200), False on 404."""
+    try:
+        s3_client.head_object(Bucket=bucket_name, Key=s3_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return True
+
+
+@task(retries=2, retry_delay_seconds=5, persist_result=False, cache_policy=NO_CACHE)
+def existing_s3_keys(bucket_name: str, s3_keys: list, aws_credentials: AwsCredentials) -> set:
+    """
+    Return the subset of s3_keys that exist in the bucket.
+
+    HEADs run on a plain thread pool inside this one task: each takes a few ms,
+    so a Prefect task per key would cost more in scheduling than the HEAD.
+    Deliberately not cached: a cached miss would outlive the upload that
+    follows it and make the next rerun re-fetch.
+    """
+    s3_client = get_s3_client(aws_credentials)
+    with ThreadPoolExecutor(max_workers=S3_HEAD_WORKERS) as executor:
+        found = executor.map(lambda key: _exists_in_s3(s3_client, bucket_name, key), s3_keys)
+        return {key for key, exists in zip(s3_keys, found) if exists}
+
+
+@task(retries=2, retry_delay_seconds=5, persist_result=False, cache_policy=NO_CACHE)
 def upload_json_to_s3(data, s3_key: str, bucket_name: str, aws_credentials: AwsCredentials) -> str:
     """Upload raw data as compact JSON to S3."""
     logger = get_run_logger()
-    s3_client = aws_credentials.get_boto3_session().client('s3')
+    s3_client = get_s3_client(aws_credentials)
     json_data = json.dumps(data)
     s3_client.put_object(
         Bucket=bucket_name,
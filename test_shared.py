@@ -0,0 +1,207 @@
+"""Tests for the pure helpers in shared.py."""
+
+import gzip
+import json
+import time
+import unittest.mock as mock
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from prefect_aws import AwsCredentials
+from urllib3.response import HTTPResponse
+from urllib3.util.retry import RequestHistory
+
+import shared
+from shared import RateLimiter, _TiingoRetry, _exists_in_s3, get_s3_client, gzip_json
+
+
+RECORDS = [
+    {"date": "2024-01-02T00:00:00.000Z", "close": 185.64, "volume": 82488700},
+    {"date": "2024-01-03T00:00:00.000Z", "close": 184.25, "volume": 58414500},
+]
+
+
+class TestGzipJson:
+    def test_round_trip(self):
+        assert json.loads(gzip.decompress(gzip_json(RECORDS))) == RECORDS
+
+    def test_compact_encoding(self):
+        assert gzip.decompress(gzip_json([{"a": 1}])) == b'[{"a":1}]'
+
+    def test_deterministic(self):
+        assert gzip_json(RECORDS) == gzip_json(RECORDS)
+
+
+class TestGetS3Client:
+    def _creds(self, access_key="AKIDEXAMPLE", **kwargs):
+        return AwsCredentials(
+            aws_access_key_id=access_key,
+            aws_secret_access_key="secret",
+            region_name="us-east-1",
+            **kwargs,
+        )
+
+    def test_cached_per_credentials(self):
+        assert get_s3_client(self._creds()) is get_s3_client(self._creds())
+
+    def test_distinct_credentials_get_distinct_clients(self):
+        assert get_s3_client(self._creds("AKID1")) is not get_s3_client(self._creds("AKID2"))
+
+    def test_pool_sized_for_concurrent_puts(self):
+        assert get_s3_client(self._creds()).meta.config.max_pool_connections == 64
+
+    def test_session_token_used(self):
+        client = get_s3_client(self._creds(aws_session_token="token-1"))
+        assert client._request_signer._credentials.token == "token-1"
+
+    def test_distinct_session_tokens_get_distinct_clients(self):
+        assert (
+            get_s3_client(self._creds(aws_session_token="token-1"))
+            is not get_s3_client(self._creds(aws_session_token="token-2"))
+        )
+
+    def test_concurrent_first_calls_build_one_client(self):
+        creds = self._creds("AKIDCONCURRENT")
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            clients = list(executor.map(lambda _: get_s3_client(creds), range(16)))
+        assert all(client is clients[0] for client in clients)
+
+    def test_block_client_parameters_applied(self):
+        client = get_s3_client(self._creds(aws_client_parameters={"endpoint_url": "http://localhost:9000"}))
+        assert client.meta.endpoint_url == "http://localhost:9000"
+        assert client.meta.config.max_pool_connections == 64
+
+
+class TestExistsInS3:
+    @pytest.fixture
+    def client(self):
+        return boto3.client(
+            "s3", region_name="us-east-1",
+            aws_access_key_id="AKIDEXAMPLE", aws_secret_access_key="secret",
+        )
+
+    def test_present(self, client):
+        with Stubber(client) as stub:
+            stub.add_response("head_object", {}, {"Bucket": "b", "Key": "k"})
+            assert _exists_in_s3(client, "b", "k") is True
+
+    def test_missing(self, client):
+        with Stubber(client) as stub:
+            stub.add_client_error("head_object", service_error_code="404", http_status_code=404)
+            assert _exists_in_s3(client, "b", "k") is False
+
+    def test_other_errors_raise(self, client):
+        with Stubber(client) as stub:
+            stub.add_client_error("head_object", service_error_code="403", http_status_code=403)
+            with pytest.raises(ClientError):
+                _exists_in_s3(client, "b", "k")
+
+
+class TestRateLimiter:
+    def test_burst_up_to_rate(self):
+        limiter = RateLimiter(rate=5, per_seconds=60)
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.acquire()
+        assert time.monotonic() - start < 0.1
+
+    def test_blocks_once_bucket_empty(self):
+        limiter = RateLimiter(rate=2, per_seconds=0.2)
+        limiter.acquire()
+        limiter.acquire()
+        start = time.monotonic()
+        limiter.acquire()
+        # One token refills in per_seconds / rate = 0.1s
+        assert time.monotonic() - start >= 0.09
+
+    def test_pause_holds_acquirers(self):
+        limiter = RateLimiter(rate=5, per_seconds=1)
+        limiter.pause(0.2)
+        start = time.monotonic()
+        limiter.acquire()
+        assert time.monotonic() - start >= 0.19
+
+    def test_no_burst_after_pause(self):
+        limiter = RateLimiter(rate=10, per_seconds=1)
+        limiter.pause(0.05)
+        limiter.acquire()
+        start = time.monotonic()
+        limiter.acquire()
+        # Bucket restarts empty, so the second call waits for a refill
+        assert time.monotonic() - start >= 0.05
+
+
+class TestTiingoGet:
+    def test_per_call_auth_and_timeout(self, monkeypatch):
+        session_get = mock.Mock()
+        monkeypatch.setattr(shared._TIINGO_SESSION, "get", session_get)
+        monkeypatch.setattr(shared, "_TIINGO_RATE_LIMITER", mock.Mock())
+
+        shared.tiingo_get("https://api.tiingo.com/tiingo/daily/AAPL/prices", "tok", {"startDate": "2024-01-01"})
+
+        session_get.assert_called_once_with(
+            "https://api.tiingo.com/tiingo/daily/AAPL/prices",
+            headers={"Authorization": "Token tok"},
+            params={"startDate": "2024-01-01"},
+            timeout=shared.TIINGO_TIMEOUT,
+        )
+
+    def test_token_not_stored_on_shared_session(self):
+        assert "Authorization" not in shared._TIINGO_SESSION.headers
+
+    def test_takes_rate_token(self, monkeypatch):
+        limiter = mock.Mock()
+        monkeypatch.setattr(shared._TIINGO_SESSION, "get", mock.Mock())
+        monkeypatch.setattr(shared, "_TIINGO_RATE_LIMITER", limiter)
+
+        shared.tiingo_get("https://api.tiingo.com/x", "tok")
+
+        limiter.acquire.assert_called_once_with()
+
+
+class TestTiingoRetry:
+    @pytest.fixture
+    def events(self, monkeypatch):
+        """Swap the shared limiter and in-flight semaphore for recorders."""
+        events = []
+        limiter = mock.Mock(
+            acquire=lambda: events.append("token"),
+            pause=lambda seconds: events.append(("pause", seconds)),
+        )
+        inflight = mock.Mock(
+            acquire=lambda: events.append("slot acquired"),
+            release=lambda: events.append("slot released"),
+        )
+        monkeypatch.setattr(shared, "_TIINGO_RATE_LIMITER", limiter)
+        monkeypatch.setattr(shared, "_TIINGO_INFLIGHT", inflight)
+        monkeypatch.setattr("urllib3.util.retry.time.sleep", lambda seconds: events.append(("sleep", seconds)))
+        return events
+
+    def test_retry_takes_token_and_frees_slot_while_waiting(self, events):
+        _TiingoRetry(total=3).sleep()
+        assert events == ["slot released", "token", "slot acquired"]
+
+    def test_429_pauses_limiter_for_retry_after(self, events):
+        _TiingoRetry(total=3).sleep(HTTPResponse(status=429, headers={"Retry-After": "2"}))
+
+        (_, paused), *rest = events
+        assert 2 <= paused <= 3  # Retry-After plus up to 1s jitter
+        assert rest == ["slot released", ("sleep", 2.0), "token", "slot acquired"]
+
+    def test_429_without_retry_after_pauses_for_backoff(self, events):
+        # Two earlier attempts: backoff = 0.5 * 2 ** (2 - 1) = 1s
+        history = (RequestHistory("GET", "/", None, 429, None),) * 2
+        retry = _TiingoRetry(total=3, backoff_factor=0.5, history=history)
+
+        retry.sleep(HTTPResponse(status=429))
+
+        assert events[0][0] == "pause"
+        assert 1 <= events[0][1] <= 2
+        assert ("sleep", 1.0) in events
+
+    def test_other_statuses_do_not_pause(self, events):
+        _TiingoRetry(total=3).sleep(HTTPResponse(status=503))
+        assert not any(isinstance(event, tuple) and event[0] == "pause" for event in events)
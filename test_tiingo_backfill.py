@@ -0,0 +1,256 @@
+"""Tests for tiingo_backfill_flow: pure helpers, plus reruns against in-memory S3 and Tiingo."""
+
+import io
+import unittest.mock as mock
+from datetime import date
+
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import requests
+from botocore.exceptions import ClientError
+from prefect_aws import AwsCredentials
+
+import shared
+import tiingo_backfill_flow as backfill
+from tiingo_backfill_flow import (
+    FETCHED_TICKERS_KEY, PARQUET_SCHEMA, build_year_table, fetched_tickers, merge_year_table, split_by_year,
+)
+
+
+def _record(day: str, close: float, volume: int = 1000000) -> dict:
+    """Build a Tiingo-shaped EOD record."""
+    return {
+        "date": f"{day}T00:00:00.000Z",
+        "open": close, "high": close, "low": close, "close": close,
+        "volume": volume,
+        "adjOpen": close, "adjHigh": close, "adjLow": close, "adjClose": close,
+        "adjVolume": volume * 1.5,
+        "divCash": 0.0,
+        "splitFactor": 1.0,
+    }
+
+
+def _result(ticker: str, records: list) -> dict:
+    return {"ticker": ticker, "year": 2024, "data": records}
+
+
+class TestSplitByYear:
+    def test_groups_records_by_year(self):
+        data = [_record("2023-12-29", 1.0), _record("2024-01-02", 2.0), _record("2024-01-03", 3.0)]
+
+        by_year = split_by_year(data, 2023, 2024)
+
+        assert [r["close"] for r in by_year[2023]] == [1.0]
+        assert [r["close"] for r in by_year[2024]] == [2.0, 3.0]
+
+    def test_every_year_in_range_present(self):
+        by_year = split_by_year([_record("2024-01-02", 2.0)], 2020, 2024)
+        assert list(by_year) == [2020, 2021, 2022, 2023, 2024]
+        assert by_year[2020] == []
+
+    def test_records_outside_range_dropped(self):
+        by_year = split_by_year([_record("2019-12-31", 1.0), _record("2020-01-02", 2.0)], 2020, 2020)
+        assert list(by_year) == [2020]
+        assert len(by_year[2020]) == 1
+
+
+class TestBuildYearTable:
+    def test_rows_from_all_tickers(self):
+        table = build_year_table([
+            _result("AAPL", [_record("2024-01-02", 185.64), _record("2024-01-03", 184.25)]),
+            _result("TSLA", [_record("2024-01-02", 248.42)]),
+        ])
+
+        assert table.num_rows == 3
+        assert table.column("ticker").to_pylist() == ["AAPL", "AAPL", "TSLA"]
+        assert table.column("date").to_pylist() == [
+            date(2024, 1, 2), date(2024, 1, 3), date(2024, 1, 2),
+        ]
+
+    def test_schema(self):
+        table = build_year_table([_result("AAPL", [_record("2024-01-02", 185.64)])])
+
+        assert table.schema == PARQUET_SCHEMA
+        assert table.schema.field("ticker").type == pa.dictionary(pa.int32(), pa.string())
+        assert table.schema.field("adjClose").type == pa.float32()
+        assert table.schema.field("volume").type == pa.int64()
+
+    def test_fractional_adj_volume_preserved(self):
+        table = build_year_table([_result("AAPL", [_record("2024-01-02", 185.64, volume=3)])])
+        assert table.column("adjVolume").to_pylist() == [4.5]
+
+    def test_ticker_without_records(self):
+        table = build_year_table([
+            _result("AAPL", [_record("2024-01-02", 185.64)]),
+            _result("NEWCO", []),
+        ])
+        assert table.column("ticker").to_pylist() == ["AAPL"]
+
+    def test_empty_year(self):
+        table = build_year_table([])
+        assert table.num_rows == 0
+        assert table.schema == PARQUET_SCHEMA
+
+
+class TestMergeYearTable:
+    def _table(self, *tickers):
+        return build_year_table([_result(t, [_record("2024-01-02", 100.0)]) for t in tickers])
+
+    def test_no_existing_table(self):
+        new = self._table("AAPL")
+        assert merge_year_table(None, new, ["AAPL"]) is new
+
+    def test_keeps_tickers_not_refetched(self):
+        merged = merge_year_table(self._table("AAPL", "TSLA"), self._table("NVDA"), ["NVDA"])
+        assert sorted(merged.column("ticker").to_pylist()) == ["AAPL", "NVDA", "TSLA"]
+
+    def test_replaces_refetched_tickers(self):
+        existing = build_year_table([_result("AAPL", [_record("2024-01-02", 1.0), _record("2024-01-03", 1.0)])])
+        new = build_year_table([_result("AAPL", [_record("2024-01-02", 2.0)])])
+
+        merged = merge_year_table(existing, new, ["AAPL"])
+
+        assert merged.column("close").to_pylist() == [2.0]
+
+    def test_per_ticker_tables_round_trip(self):
+        # fetch_range builds one table per ticker, so each carries its own dictionary
+        new = pa.concat_tables([self._table("NVDA"), self._table("TSLA")])
+        merged = merge_year_table(self._table("AAPL", "TSLA"), new, ["NVDA", "TSLA"])
+
+        buf = io.BytesIO()
+        pq.write_table(merged, buf)
+        table = pq.read_table(io.BytesIO(buf.getvalue()))
+
+        assert sorted(table.column("ticker").to_pylist()) == ["AAPL", "NVDA", "TSLA"]
+
+    def test_refetched_ticker_with_no_records_removed(self):
+        merged = merge_year_table(self._table("AAPL", "TSLA"), build_year_table([_result("TSLA", [])]), ["TSLA"])
+        assert merged.column("ticker").to_pylist() == ["AAPL"]
+
+
+class TestFetchedTickers:
+    def test_none(self):
+        assert fetched_tickers(None) == set()
+
+    def test_tickers_with_rows(self):
+        table = build_year_table([_result("AAPL", [_record("2024-01-02", 1.0)])])
+        assert fetched_tickers(table) == {"AAPL"}
+
+    def test_recorded_tickers_without_rows(self):
+        table = build_year_table([_result("AAPL", [_record("2024-01-02", 1.0)])])
+        table = table.replace_schema_metadata({FETCHED_TICKERS_KEY: orjson.dumps(["AAPL", "NEWCO"])})
+        assert fetched_tickers(table) == {"AAPL", "NEWCO"}
+
+
+class FakeS3:
+    """The slice of the S3 client API the backfill uses, backed by a dict."""
+
+    def __init__(self):
+        self.objects = {}
+        self.puts = []
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+        self.puts.append(Key)
+
+    def upload_fileobj(self, fileobj, bucket, key, **kwargs):
+        self.objects[key] = fileobj.read()
+        self.puts.append(key)
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+
+# NEWCO lists in 2023, so has no records for 2021-2022
+LISTED = {"AAPL": 2021, "NEWCO": 2023}
+
+
+@pytest.mark.usefixtures("prefect_harness")
+class TestBackfillReruns:
+    @pytest.fixture
+    def s3(self):
+        return FakeS3()
+
+    @pytest.fixture
+    def fetches(self, s3):
+        fetches = []
+
+        def fake_tiingo_get(url, api_token, params=None):
+            ticker = url.split("/")[-2]
+            start, end = int(params["startDate"][:4]), int(params["endDate"][:4])
+            fetches.append((ticker, start, end))
+            if ticker not in LISTED:
+                response = mock.Mock()
+                response.raise_for_status.side_effect = requests.HTTPError("404 Not Found")
+                return response
+            records = [
+                _record(f"{year}-01-02", 100.0)
+                for year in range(max(start, LISTED[ticker]), end + 1)
+            ]
+            return mock.Mock(content=orjson.dumps(records), raise_for_status=lambda: None)
+
+        creds = AwsCredentials(aws_access_key_id="AKIDEXAMPLE", aws_secret_access_key="secret")
+        with mock.patch.object(backfill, "tiingo_get", fake_tiingo_get), \
+             mock.patch.object(backfill, "load_credentials", lambda: ("token", creds)), \
+             mock.patch.object(shared, "_get_s3_client", lambda aws_credentials: s3):
+            yield fetches
+
+    def test_rerun_with_empty_ticker_years_makes_no_calls(self, s3, fetches):
+        backfill.tiingo_backfill_flow(2021, 2024, tickers=["AAPL", "NEWCO"])
+        assert sorted(fetches) == [("AAPL", 2021, 2024), ("NEWCO", 2021, 2024)]
+        fetches.clear()
+        s3.puts.clear()
+
+        result = backfill.tiingo_backfill_flow(2021, 2024, tickers=["AAPL", "NEWCO"])
+
+        assert fetches == []
+        assert s3.puts == []
+        assert result["skipped_files"] == 8
+
+    def test_current_year_always_refetched(self, s3, fetches):
+        current_year = date.today().year
+        backfill.tiingo_backfill_flow(current_year - 1, current_year, tickers=["AAPL"])
+        fetches.clear()
+        s3.puts.clear()
+
+        result = backfill.tiingo_backfill_flow(current_year - 1, current_year, tickers=["AAPL"])
+
+        # The finished year is skipped; the year still trading is re-fetched
+        assert fetches == [("AAPL", current_year, current_year)]
+        assert result["skipped_files"] == 1
+        assert s3.puts == [backfill._json_key("AAPL", current_year), backfill._parquet_key(current_year)]
+
+    def test_failed_ticker_does_not_block_parquet(self, s3, fetches):
+        # DELISTED is not in LISTED, so Tiingo 404s for it
+        with mock.patch.object(backfill, "fetch_range", backfill.fetch_range.with_options(retries=0)):
+            with pytest.raises(RuntimeError, match="DELISTED"):
+                backfill.tiingo_backfill_flow(2021, 2022, tickers=["AAPL", "DELISTED"])
+
+        for year in (2021, 2022):
+            table = pq.read_table(io.BytesIO(s3.objects[backfill._parquet_key(year)]))
+            assert fetched_tickers(table) == {"AAPL"}
+        fetches.clear()
+
+        # Rerunning without the bad ticker has nothing left to fetch
+        backfill.tiingo_backfill_flow(2021, 2022, tickers=["AAPL"])
+        assert fetches == []
+
+    def test_new_ticker_merged_into_existing_years(self, s3, fetches):
+        backfill.tiingo_backfill_flow(2021, 2022, tickers=["AAPL"])
+        fetches.clear()
+
+        backfill.tiingo_backfill_flow(2021, 2022, tickers=["AAPL", "NEWCO"])
+
+        assert fetches == [("NEWCO", 2021, 2022)]
+        table = pq.read_table(io.BytesIO(s3.objects[backfill._parquet_key(2021)]))
+        assert table.column("ticker").to_pylist() == ["AAPL"]
+        assert fetched_tickers(table) == {"AAPL", "NEWCO"}
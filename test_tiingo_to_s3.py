@@ -0,0 +1,57 @@
+"""Flow-level test for tiingo_to_s3_flow against in-memory S3 and Tiingo."""
+
+import gzip
+import unittest.mock as mock
+from datetime import datetime
+
+import orjson
+import pytest
+from prefect.runtime import task_run
+from prefect_aws import AwsCredentials
+
+import shared
+import tiingo_to_s3_flow as daily
+
+
+TICKERS = ["AAPL", "MSFT", "TSLA"]
+
+
+@pytest.mark.usefixtures("prefect_harness")
+class TestDailyFlow:
+    @pytest.fixture
+    def run(self):
+        calls = []
+        puts = []
+
+        def fake_tiingo_get(url, api_token, params=None):
+            calls.append((url.split("/")[-2], task_run.id))
+            records = [{"date": "2024-01-02T00:00:00.000Z", "close": 185.64}]
+            return mock.Mock(content=orjson.dumps(records), raise_for_status=lambda: None)
+
+        s3 = mock.Mock(put_object=lambda **kwargs: puts.append(kwargs))
+        creds = AwsCredentials(aws_access_key_id="AKIDEXAMPLE", aws_secret_access_key="secret")
+        with mock.patch.object(daily, "tiingo_get", fake_tiingo_get), \
+             mock.patch.object(daily, "load_credentials", lambda: ("token", creds)), \
+             mock.patch.object(daily, "fetch_tickers_from_s3", lambda *args: TICKERS), \
+             mock.patch.object(shared, "_get_s3_client", lambda aws_credentials: s3):
+            keys = daily.tiingo_to_s3_flow()
+        return keys, calls, puts
+
+    def test_one_extract_task_per_ticker(self, run):
+        _, calls, _ = run
+        assert sorted(ticker for ticker, _ in calls) == TICKERS
+        assert len({task_run_id for _, task_run_id in calls}) == len(TICKERS)
+
+    def test_uploads_gzipped_json_per_ticker(self, run):
+        keys, _, puts = run
+        date_partition = datetime.now().strftime('%Y-%m-%d')
+
+        assert keys == [
+            f"tiingo/json/price_eod/load_type=daily/date={date_partition}/{ticker}.json.gz"
+            for ticker in TICKERS
+        ]
+        assert [put["Key"] for put in puts] == keys
+        for put in puts:
+            assert put["ContentEncoding"] == "gzip"
+            assert put["ContentType"] == "application/json"
+            assert orjson.loads(gzip.decompress(put["Body"]))[0]["close"] == 185.64
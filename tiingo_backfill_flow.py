@@ -4,78 +4,268 @@ Tiingo Historical Data Backfill Pipeline
 Fetches historical price data from Tiingo API and loads to S3 with year-level partitioning.
 Uses type-partitioned structure for efficient querying and processing.
 
-S3 Structure: s3://mh-guess-data/tiingo/json/price_eod/load_type=retro/year={YYYY}/{ticker}.json
-
-Each file contains all trading days for that ticker in that year (~252 records).
-This minimizes API calls: 1 call per ticker per year instead of 1 per day.
+S3 Structure:
+  Raw archive:  s3://mh-guess-data/tiingo/json/price_eod/load_type=retro/year={YYYY}/{ticker}.json.gz
+  Coalesced:    s3://mh-guess-data/tiingo/parquet/price_eod/load_type=retro/year={YYYY}/part-0.parquet
+
+Each JSON file contains all trading days for that ticker in that year (~252 records).
+This minimizes API calls: 1 call per ticker for the whole year range, split
+into year partitions locally.
+The Parquet file holds the same records for every ticker in the year, so
+downstream readers make 1 GET per year instead of 1 per ticker.
 """
 
 from prefect import flow, task, get_run_logger
-from datetime import datetime
-import requests
-import json
-from typing import Optional, List
+from prefect.cache_policies import NO_CACHE
+from prefect.futures import as_completed
+from prefect.task_runners import ThreadPoolTaskRunner
+from datetime import datetime, date
+from itertools import groupby
+from typing import Optional, List, Tuple
+import io
+import orjson
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 
 from prefect_aws import AwsCredentials
-from shared import S3_BUCKET_NAME, TICKERS_S3_KEY, fetch_tickers_from_s3, load_credentials
+from shared import (
+    S3_BUCKET_NAME, TICKERS_S3_KEY,
+    existing_s3_keys, fetch_tickers_from_s3, get_s3_client, gzip_json, load_credentials, tiingo_get,
+)
+
+# Ticker fetches and year uploads are I/O-bound (Tiingo HTTP + S3 PUT), so they run concurrently
+# on a thread pool. In-flight Tiingo calls are capped separately by
+# shared.TIINGO_MAX_INFLIGHT, leaving spare threads free for S3 uploads.
+MAX_WORKERS = 16
+
+PRICE_COLUMNS = ['open', 'high', 'low', 'close', 'adjOpen', 'adjHigh', 'adjLow', 'adjClose']
+# adjVolume can be fractional after split adjustment, so it stays float64
+FLOAT64_COLUMNS = ['adjVolume', 'divCash', 'splitFactor']
+
+PARQUET_SCHEMA = pa.schema(
+    [
+        ('ticker', pa.dictionary(pa.int32(), pa.string())),
+        ('date', pa.date32()),
+    ]
+    + [(c, pa.float32()) for c in PRICE_COLUMNS]
+    + [('volume', pa.int64())]
+    + [(c, pa.float64()) for c in FLOAT64_COLUMNS]
+)
+
+# Schema metadata key listing every ticker fetched into a year's Parquet,
+# including those with no rows that year (not yet listed, or delisted)
+FETCHED_TICKERS_KEY = b'fetched_tickers'
+
+# Year Parquet files grow with the ticker universe; past 8 MB they go up as
+# parallel 16 MB multipart chunks instead of one single-stream PUT.
+PARQUET_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True,
+)
+
+
+def _json_key(ticker: str, year: int) -> str:
+    return f"tiingo/json/price_eod/load_type=retro/year={year}/{ticker}.json.gz"
+
+
+def _parquet_key(year: int) -> str:
+    return f"tiingo/parquet/price_eod/load_type=retro/year={year}/part-0.parquet"
+
+
+def split_by_year(data: list, start_year: int, end_year: int) -> dict:
+    """
+    Group Tiingo records into {year: records} for every year in the range.
+
+    Years with no trading days (e.g. before a listing) map to an empty list so
+    each partition still gets a file.
+    """
+    by_year = {year: [] for year in range(start_year, end_year + 1)}
+    # Tiingo returns records in date order, so each year is one contiguous run
+    for year_str, records in groupby(data, key=lambda r: r['date'][:4]):
+        if int(year_str) in by_year:
+            by_year[int(year_str)].extend(records)
+    return by_year
 
 
-@task(retries=3, retry_delay_seconds=10)
-def fetch_year_data(ticker: str, year: int, api_token: str) -> dict:
+@task(retries=3, retry_delay_seconds=10, persist_result=False, cache_policy=NO_CACHE)
+def fetch_range(ticker: str, start_year: int, end_year: int, api_token: str) -> list:
     """
-    Fetch all daily price data for a ticker for a specific year from Tiingo API.
+    Fetch all daily price data for a ticker across a year range in one API call.
 
     Args:
         ticker: Stock ticker symbol
-        year: Year to fetch (e.g., 2020)
+        start_year: First year to fetch (inclusive), e.g., 2020
+        end_year: Last year to fetch (inclusive), e.g., 2024
         api_token: Tiingo API token
 
     Returns:
-        Dictionary with ticker, year, and data
+        List of per-year dictionaries with ticker, year, the year's raw JSON
+        gzip'd for upload, and its records as an Arrow table for the Parquet
+        coalesce
     """
     logger = get_run_logger()
-    logger.info(f"Fetching {year} data for {ticker}...")
+    logger.info(f"Fetching {start_year}-{end_year} data for {ticker}...")
 
     # Tiingo API endpoint for daily prices
-    start_date = f"{year}-01-01"
-    end_date = f"{year}-12-31"
-
     url = f"https://api.tiingo.com/tiingo/daily/{ticker}/prices"
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Token {api_token}'
-    }
     params = {
-        'startDate': start_date,
-        'endDate': end_date
+        'startDate': f"{start_year}-01-01",
+        'endDate': f"{end_year}-12-31"
     }
 
-    response = requests.get(url, headers=headers, params=params)
+    response = tiingo_get(url, api_token, params)
     response.raise_for_status()
 
-    data = response.json()
-    logger.info(f"Fetched {len(data)} records for {ticker} in {year}")
+    data = orjson.loads(response.content)
+    logger.info(f"Fetched {len(data)} records for {ticker} in {start_year}-{end_year}")
+
+    fetched_at = datetime.now().isoformat()
+    return [
+        {
+            "ticker": ticker,
+            "year": year,
+            # Encoded here, on the task's thread, so the record dicts are freed
+            # with the task: the flow only holds compressed bytes and columnar
+            # rows until the uploads and Parquet write finish
+            "payload": gzip_json(records),
+            "table": build_year_table([{"ticker": ticker, "data": records}]),
+            "record_count": len(records),
+            "fetched_at": fetched_at
+        }
+        for year, records in split_by_year(data, start_year, end_year).items()
+    ]
+
+
+@task(retries=2, retry_delay_seconds=5, persist_result=False, cache_policy=NO_CACHE)
+def load_ticker_years_to_s3(
+    ticker: str,
+    per_year_payloads: List[Tuple[int, bytes]],
+    bucket_name: str,
+    aws_credentials: AwsCredentials
+) -> List[str]:
+    """
+    Load all of a ticker's year-level historical data to S3 with type=retro partition.
 
-    return {
-        "ticker": ticker,
-        "year": year,
-        "data": data,
-        "record_count": len(data),
-        "fetched_at": datetime.now().isoformat()
-    }
+    One task per ticker rather than per (ticker, year): the PUTs are short, so
+    per-task Prefect overhead would otherwise dominate. A retry re-uploads
+    every year for the ticker, which is safe since each PUT overwrites.
+
+    Args:
+        ticker: Stock ticker symbol
+        per_year_payloads: (year, gzip'd JSON) pairs to upload
+        bucket_name: S3 bucket name
+        aws_credentials: AWS credentials from Prefect Cloud
+
+    Returns:
+        S3 keys of uploaded files
+    """
+    logger = get_run_logger()
+
+    # Shared S3 client, cached per credential set
+    s3_client = get_s3_client(aws_credentials)
+
+    s3_keys = []
+    for year, payload in per_year_payloads:
+        s3_key = _json_key(ticker, year)
+
+        # Raw data as-is (compact JSON, gzip-encoded by fetch_range)
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=s3_key,
+            Body=payload,
+            ContentType='application/json',
+            ContentEncoding='gzip'
+        )
+        s3_keys.append(s3_key)
+
+    logger.info(
+        f"Uploaded {len(s3_keys)} years of {ticker} data "
+        f"({sum(len(payload) for _, payload in per_year_payloads):,} bytes) to s3://{bucket_name}/"
+    )
+    return s3_keys
+
+
+def build_year_table(year_results: list) -> pa.Table:
+    """
+    Build one table from {ticker, data} results for a single year.
+
+    Prices are stored as float32 and tickers dictionary-encoded; the raw JSON
+    archive keeps full-precision values.
+    """
+    columns = {name: [] for name in PARQUET_SCHEMA.names}
+    for result in year_results:
+        for record in result["data"]:
+            columns['ticker'].append(result["ticker"])
+            columns['date'].append(date.fromisoformat(record['date'][:10]))
+            for c in PRICE_COLUMNS + ['volume'] + FLOAT64_COLUMNS:
+                columns[c].append(record.get(c))
+
+    return pa.Table.from_pydict(columns, schema=PARQUET_SCHEMA)
+
+
+def merge_year_table(existing: Optional[pa.Table], new: pa.Table, tickers: list) -> pa.Table:
+    """
+    Upsert `new` into an existing year table.
+
+    Rows for `tickers` (the tickers just fetched, even those with no records)
+    are replaced; rows for every other ticker are kept.
+    """
+    if existing is None:
+        return new
+    existing = existing.cast(PARQUET_SCHEMA)
+    replaced = pc.is_in(existing['ticker'], value_set=pa.array(tickers, pa.string()))
+    return pa.concat_tables([existing.filter(pc.invert(replaced)), new])
 
 
-@task(retries=2, retry_delay_seconds=5)
-def load_year_to_s3(
-    ticker_year_data: dict,
+def fetched_tickers(table: Optional[pa.Table]) -> set:
+    """
+    Tickers a year's Parquet already covers: those recorded in its
+    FETCHED_TICKERS_KEY metadata plus any with rows (files written before the
+    metadata existed only have the latter).
+    """
+    if table is None:
+        return set()
+    metadata = table.schema.metadata or {}
+    recorded = orjson.loads(metadata[FETCHED_TICKERS_KEY]) if FETCHED_TICKERS_KEY in metadata else []
+    return set(recorded) | set(table.column('ticker').to_pylist())
+
+
+@task(retries=2, retry_delay_seconds=5, persist_result=False, cache_policy=NO_CACHE)
+def read_year_parquet(year: int, bucket_name: str, aws_credentials: AwsCredentials) -> Optional[pa.Table]:
+    """Read a year's existing Parquet from S3, or None if it has not been written yet."""
+    s3_client = get_s3_client(aws_credentials)
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=_parquet_key(year))
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+    return pq.read_table(io.BytesIO(response['Body'].read()))
+
+
+@task(retries=2, retry_delay_seconds=5, persist_result=False, cache_policy=NO_CACHE)
+def load_year_parquet_to_s3(
+    year: int,
+    ticker_tables: List[Tuple[str, pa.Table]],
+    existing: Optional[pa.Table],
     bucket_name: str,
     aws_credentials: AwsCredentials
 ) -> str:
     """
-    Load year-level historical data to S3 with type=retro partition.
+    Load one year of all tickers' data to S3 as a single Parquet object.
 
     Args:
-        ticker_year_data: Dictionary with ticker, year, and data
+        year: Year partition
+        ticker_tables: (ticker, table) pairs from fetch_range for the tickers
+            fetched this run
+        existing: The year's current Parquet table (None if not yet written);
+            its rows for tickers not fetched this run are carried over
         bucket_name: S3 bucket name
         aws_credentials: AWS credentials from Prefect Cloud
 
@@ -83,37 +273,45 @@ def load_year_to_s3(
         S3 key of uploaded file
     """
     logger = get_run_logger()
-    ticker = ticker_year_data["ticker"]
-    year = ticker_year_data["year"]
-    data = ticker_year_data["data"]
-
-    s3_key = f"tiingo/json/price_eod/load_type=retro/year={year}/{ticker}.json"
-
-    logger.info(f"Loading {ticker} {year} data ({len(data)} records) to S3...")
-
-    # Get S3 client using AWS credentials from Prefect Cloud
-    s3_client = aws_credentials.get_boto3_session().client('s3')
-
-    # Save raw data as-is (compact JSON, no pretty formatting)
-    json_data = json.dumps(data)
+    tickers = [ticker for ticker, _ in ticker_tables]
+    new = pa.concat_tables([table for _, table in ticker_tables])
+    table = merge_year_table(existing, new, tickers)
+    # Record zero-row tickers too, so reruns don't re-fetch them every time
+    table = table.replace_schema_metadata({
+        FETCHED_TICKERS_KEY: orjson.dumps(sorted(fetched_tickers(existing) | set(tickers)))
+    })
+
+    s3_key = _parquet_key(year)
+
+    logger.info(
+        f"Loading {year} Parquet ({len(tickers)} tickers fetched, "
+        f"{table.num_rows} rows total) to S3..."
+    )
 
-    # Upload to S3
-    s3_client.put_object(
-        Bucket=bucket_name,
-        Key=s3_key,
-        Body=json_data,
-        ContentType='application/json'
+    buf = io.BytesIO()
+    pq.write_table(table, buf, compression='zstd', row_group_size=100_000)
+    size = buf.tell()
+    buf.seek(0)
+
+    s3_client = get_s3_client(aws_credentials)
+    s3_client.upload_fileobj(
+        buf,
+        bucket_name,
+        s3_key,
+        Config=PARQUET_TRANSFER_CONFIG,
+        ExtraArgs={'ContentType': 'application/x-parquet'}
     )
 
-    logger.info(f"Uploaded to s3://{bucket_name}/{s3_key}")
+    logger.info(f"Uploaded {size:,} bytes to s3://{bucket_name}/{s3_key}")
     return s3_key
 
 
-@flow(name="Tiingo Historical Backfill")
+@flow(name="Tiingo Historical Backfill", task_runner=ThreadPoolTaskRunner(max_workers=MAX_WORKERS))
 def tiingo_backfill_flow(
     start_year: int,
     end_year: int,
-    tickers: Optional[List[str]] = None
+    tickers: Optional[List[str]] = None,
+    overwrite: bool = False
 ):
     """
     Backfill historical Tiingo data with year-level partitioning.
@@ -121,12 +319,19 @@ def tiingo_backfill_flow(
     This flow fetches historical price data and saves it to S3 with:
     - Type partition: load_type=retro
     - Year partition: year={YYYY}
-    - One file per ticker per year
+    - One JSON file per ticker per year
+    - One Parquet file per year covering all tickers
+
+    A (ticker, year) pair whose JSON file exists and whose ticker is already
+    recorded in the year's Parquet (even with no rows) is skipped, so reruns
+    only fetch what is missing. The current year (and any later one) is
+    still trading, so it is always re-fetched.
 
     Args:
         start_year: Start year for backfill (inclusive), e.g., 2020
         end_year: End year for backfill (inclusive), e.g., 2024
         tickers: Optional list of tickers. If None, fetches from S3.
+        overwrite: Re-fetch and re-upload every pair, even if already in S3.
 
     Example:
         # Backfill 2020-2024 for all tickers in S3
@@ -151,35 +356,111 @@ def tiingo_backfill_flow(
     else:
         logger.info(f"Using provided tickers: {', '.join(tickers)}")
 
-    # Calculate total operations
     years = list(range(start_year, end_year + 1))
-    total_ops = len(tickers) * len(years)
-    logger.info(f"Backfill plan: {len(tickers)} tickers × {len(years)} years = {total_ops} API calls")
-
-    # Track results
-    uploaded_keys = []
 
-    # Process each ticker and year
-    for ticker in tickers:
-        for year in years:
-            # Fetch year data
-            year_data = fetch_year_data(ticker, year, api_token)
+    # Existing year Parquet files: merged into on write, and the record of
+    # which tickers each year already covers
+    parquet_futures = {
+        year: read_year_parquet.submit(year, S3_BUCKET_NAME, aws_credentials)
+        for year in years
+    }
+    existing_tables = {year: future.result() for year, future in parquet_futures.items()}
+
+    # Pre-flight: HEAD every JSON key (in one task) and find the years each
+    # ticker still needs. Years not yet over always count as missing: a
+    # partial year written earlier would otherwise never pick up new days.
+    current_year = datetime.now().year
+    missing_years = {ticker: list(years) for ticker in tickers}
+    if not overwrite:
+        parquet_tickers = {year: fetched_tickers(table) for year, table in existing_tables.items()}
+        json_keys = existing_s3_keys(
+            S3_BUCKET_NAME,
+            [_json_key(ticker, year) for ticker in tickers for year in years],
+            aws_credentials
+        )
+        for ticker in tickers:
+            missing_years[ticker] = [
+                year for year in years
+                if year >= current_year
+                or not (_json_key(ticker, year) in json_keys and ticker in parquet_tickers[year])
+            ]
+
+    pending = {ticker: ys for ticker, ys in missing_years.items() if ys}
+    total_files = sum(len(ys) for ys in pending.values())
+    skipped_files = len(tickers) * len(years) - total_files
+    logger.info(
+        f"Backfill plan: {len(tickers)} tickers × {len(years)} years = {total_files} files "
+        f"from {len(pending)} API calls ({skipped_files} already in S3)"
+    )
 
-            # Load to S3
-            s3_key = load_year_to_s3(year_data, S3_BUCKET_NAME, aws_credentials)
-            uploaded_keys.append(s3_key)
+    # One range fetch per ticker, spanning only its missing years; queue its
+    # year uploads (one task per ticker) as soon as it lands
+    fetch_futures = {
+        fetch_range.submit(ticker, min(ys), max(ys), api_token): ticker
+        for ticker, ys in pending.items()
+    }
+    year_tables = {year: [] for year in years}
+    load_futures = []
+    failed_tickers = []
+    for fetch_future in as_completed(fetch_futures):
+        # A ticker that still fails after its retries (e.g. delisted or renamed,
+        # so Tiingo 404s) must not stop the other tickers' Parquet writes;
+        # the flow fails once they are done
+        try:
+            fetched = fetch_future.result()
+        except Exception:
+            failed_tickers.append(fetch_futures[fetch_future])
+            continue
+        ticker_years = [
+            ticker_year_data for ticker_year_data in fetched
+            if ticker_year_data["year"] in missing_years[ticker_year_data["ticker"]]
+        ]
+        for ticker_year_data in ticker_years:
+            year_tables[ticker_year_data["year"]].append(
+                (ticker_year_data["ticker"], ticker_year_data["table"])
+            )
+        load_futures.append(
+            load_ticker_years_to_s3.submit(
+                ticker_years[0]["ticker"],
+                [(ticker_year_data["year"], ticker_year_data["payload"]) for ticker_year_data in ticker_years],
+                S3_BUCKET_NAME,
+                aws_credentials
+            )
+        )
+
+    # One Parquet per year with new data, merged with the tickers already in it
+    parquet_futures = [
+        load_year_parquet_to_s3.submit(
+            year, year_tables[year], existing_tables[year], S3_BUCKET_NAME, aws_credentials
+        )
+        for year in years
+        if year_tables[year]
+    ]
+
+    # Collect as uploads finish; .result() re-raises the first failed ticker
+    uploaded_keys = [key for future in as_completed(load_futures) for key in future.result()]
+    parquet_keys = [future.result() for future in parquet_futures]
+
+    if failed_tickers:
+        raise RuntimeError(
+            f"Tiingo fetch failed for {len(failed_tickers)} tickers: {', '.join(sorted(failed_tickers))} "
+            f"({len(uploaded_keys)} JSON + {len(parquet_keys)} Parquet files for the rest were uploaded)"
+        )
 
     logger.info("="*60)
     logger.info("Backfill completed successfully!")
-    logger.info(f"Total files uploaded: {len(uploaded_keys)}")
+    logger.info(f"Total files uploaded: {len(uploaded_keys)} JSON + {len(parquet_keys)} Parquet")
     logger.info(f"Years processed: {start_year}-{end_year}")
     logger.info(f"Tickers processed: {', '.join(tickers)}")
     logger.info(f"Data location: s3://{S3_BUCKET_NAME}/tiingo/json/price_eod/load_type=retro/")
+    logger.info(f"Parquet location: s3://{S3_BUCKET_NAME}/tiingo/parquet/price_eod/load_type=retro/")
     logger.info("="*60)
 
     return {
         "uploaded_keys": uploaded_keys,
+        "parquet_keys": parquet_keys,
         "total_files": len(uploaded_keys),
+        "skipped_files": skipped_files,
         "years": years,
         "tickers": tickers
     }
@@ -4,21 +4,29 @@ Tiingo to S3 Daily ETL Pipeline
 Fetches daily price data from Tiingo API and loads it to AWS S3.
 Uses Prefect Cloud Blocks for secure credential management.
 
-S3 Structure: s3://mh-guess-data/tiingo/json/price_eod/load_type=daily/date={YYYY-MM-DD}/{ticker}.json
+S3 Structure: s3://mh-guess-data/tiingo/json/price_eod/load_type=daily/date={YYYY-MM-DD}/{ticker}.json.gz
 
 This is the incremental daily pipeline. For historical backfills, see tiingo_backfill_flow.py.
 """
 
-from prefect import flow, task, get_run_logger
+from prefect import flow, task, get_run_logger, unmapped
+from prefect.task_runners import ThreadPoolTaskRunner
+from prefect.cache_policies import NO_CACHE
 from datetime import datetime, timedelta
-import requests
-import json
+import orjson
 
 from prefect_aws import AwsCredentials
-from shared import S3_BUCKET_NAME, TICKERS_S3_KEY, fetch_tickers_from_s3, load_credentials
+from shared import (
+    S3_BUCKET_NAME, TICKERS_S3_KEY,
+    fetch_tickers_from_s3, get_s3_client, gzip_json, load_credentials, tiingo_get,
+)
 
+# One extract task per ticker runs on this pool. Tiingo concurrency is capped
+# separately by shared.TIINGO_MAX_INFLIGHT, so extra workers would only queue.
+MAX_WORKERS = 8
 
-@task(retries=3, retry_delay_seconds=10)
+
+@task(retries=3, retry_delay_seconds=10, persist_result=False, cache_policy=NO_CACHE)
 def extract_ticker_data(ticker: str, api_token: str) -> dict:
     """
     Extract daily price data from Tiingo API for a single ticker.
@@ -39,19 +47,15 @@ def extract_ticker_data(ticker: str, api_token: str) -> dict:
     start_date = end_date - timedelta(days=30)
 
     url = f"https://api.tiingo.com/tiingo/daily/{ticker}/prices"
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Token {api_token}'
-    }
     params = {
         'startDate': start_date.strftime('%Y-%m-%d'),
         'endDate': end_date.strftime('%Y-%m-%d')
     }
 
-    response = requests.get(url, headers=headers, params=params)
+    response = tiingo_get(url, api_token, params)
     response.raise_for_status()
 
-    data = response.json()
+    data = orjson.loads(response.content)
     logger.info(f"Extracted {len(data)} records for {ticker}")
 
     return {
@@ -61,61 +65,7 @@ def extract_ticker_data(ticker: str, api_token: str) -> dict:
     }
 
 
-@task
-def extract_all_tickers(tickers: list, api_token: str) -> list:
-    """
-    Extract data for all tickers.
-
-    Args:
-        tickers: List of ticker symbols
-        api_token: Tiingo API token
-
-    Returns:
-        List of ticker data dictionaries
-    """
-    all_data = []
-    for ticker in tickers:
-        ticker_data = extract_ticker_data(ticker, api_token)
-        all_data.append(ticker_data)
-
-    return all_data
-
-
-@task
-def transform_data(ticker_data_list: list) -> dict:
-    """
-    Transform extracted data into a structured format.
-
-    Args:
-        ticker_data_list: List of ticker data dictionaries
-
-    Returns:
-        Transformed data dictionary
-    """
-    logger = get_run_logger()
-    logger.info("Transforming data...")
-
-    # Extract ticker symbols from the data
-    tickers = [td["ticker"] for td in ticker_data_list]
-
-    transformed = {
-        "metadata": {
-            "extracted_at": datetime.now().isoformat(),
-            "tickers": tickers,
-            "record_count": sum(len(td["data"]) for td in ticker_data_list)
-        },
-        "tickers": {}
-    }
-
-    for ticker_data in ticker_data_list:
-        ticker = ticker_data["ticker"]
-        transformed["tickers"][ticker] = ticker_data["data"]
-
-    logger.info(f"Transformed data for {len(ticker_data_list)} tickers")
-    return transformed
-
-
-@task(retries=2, retry_delay_seconds=5)
+@task(retries=2, retry_delay_seconds=5, persist_result=False, cache_policy=NO_CACHE)
 def load_to_s3(ticker_data_list: list, bucket_name: str, aws_credentials: AwsCredentials) -> list:
     """
     Load raw Tiingo data to AWS S3, partitioned by date.
@@ -136,8 +86,8 @@ def load_to_s3(ticker_data_list: list, bucket_name: str, aws_credentials: AwsCre
     current_date = datetime.now()
     date_partition = current_date.strftime('%Y-%m-%d')
 
-    # Get S3 client using AWS credentials from Prefect Cloud
-    s3_client = aws_credentials.get_boto3_session().client('s3')
+    # Shared S3 client, cached per credential set
+    s3_client = get_s3_client(aws_credentials)
     uploaded_keys = []
 
     # Save each ticker's raw data separately with type and date partitioning
@@ -145,17 +95,18 @@ def load_to_s3(ticker_data_list: list, bucket_name: str, aws_credentials: AwsCre
         ticker = ticker_data["ticker"]
         raw_data = ticker_data["data"]  # Raw data from Tiingo API
 
-        s3_key = f"tiingo/json/price_eod/load_type=daily/date={date_partition}/{ticker}.json"
+        s3_key = f"tiingo/json/price_eod/load_type=daily/date={date_partition}/{ticker}.json.gz"
 
-        # Save raw data as-is (compact JSON, no pretty formatting)
-        json_data = json.dumps(raw_data)
+        # Save raw data as-is (compact JSON, gzip-encoded)
+        body = gzip_json(raw_data)
 
         # Upload to S3
         s3_client.put_object(
             Bucket=bucket_name,
             Key=s3_key,
-            Body=json_data,
-            ContentType='application/json'
+            Body=body,
+            ContentType='application/json',
+            ContentEncoding='gzip'
         )
 
         uploaded_keys.append(s3_key)
@@ -165,7 +116,7 @@ def load_to_s3(ticker_data_list: list, bucket_name: str, aws_credentials: AwsCre
     return uploaded_keys
 
 
-@flow(name="Tiingo to S3 ETL")
+@flow(name="Tiingo to S3 ETL", task_runner=ThreadPoolTaskRunner(max_workers=MAX_WORKERS))
 def tiingo_to_s3_flow():
     """
     Main ETL flow that orchestrates data extraction from Tiingo
@@ -182,8 +133,8 @@ def tiingo_to_s3_flow():
     # Fetch tickers from S3
     tickers = fetch_tickers_from_s3(S3_BUCKET_NAME, TICKERS_S3_KEY, aws_credentials)
 
-    # Extract
-    raw_data = extract_all_tickers(tickers, api_token)
+    # Extract: one task per ticker, so each gets its own retries
+    raw_data = extract_ticker_data.map(tickers, api_token=unmapped(api_token))
 
     # Load raw data directly to S3 (no transformation)
     s3_keys = load_to_s3(raw_data, S3_BUCKET_NAME, aws_credentials)